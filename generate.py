@@ -1,13 +1,66 @@
-# Each of these imports, besides the AlgoSDK are part of the Python Standard Library
+# Each of these imports, besides the AlgoSDK and PyNaCl (which the AlgoSDK
+# itself uses to make keys) are part of the Python Standard Library
 import argparse                         # Handles the command line inputs
 from multiprocessing import \
-    Process, Queue, Value, cpu_count    # For running on multiple CPU cores
-from queue import Empty                 # For helping read from the queue
-import itertools                        # To help us count the number of addresses we're generating
-import os                               # For managing the files we are writing to
+    Process, Lock, Pipe, RawArray, \
+    cpu_count                           # For running on multiple CPU cores
+from multiprocessing.connection import \
+    wait                                # For sleeping until a subprocess finds something
+import struct                           # For reading and writing the memory the processes share
+import time                             # For timing how fast we're going
+import base64                           # For packing the private key the way the AlgoSDK expects
+import hashlib                          # For computing address checksums
+import os                               # For managing the files we are writing to and random numbers
 import json                             # For compiling the JSON we're writing
 import re                               # To check that the requested value is possible
-from algosdk import account, mnemonic   # For generating the accounts
+from algosdk import encoding, mnemonic  # For turning keys into addresses and mnemonics
+from nacl.bindings import \
+    crypto_sign_seed_keypair, \
+    randombytes_buf_deterministic       # For generating the accounts
+
+# Every Algorand key is made from a random 32 byte "seed"
+KEY_LEN = 32
+# An address is the 32 byte public key followed by a 4 byte checksum
+CHECKSUM_LEN = 4
+# The 32 characters used to write an address, in order. Each one stands for
+# 5 bits of the public key and checksum
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+# hashlib can only do the SHA-512/256 hash addresses use if Python was built
+# with a recent enough OpenSSL. If it can't we fall back on the AlgoSDK
+HAS_SHA512_256 = 'sha512_256' in hashlib.algorithms_available
+# How many accounts each subprocess generates at a time before checking in
+BATCH_SIZE = 1024
+# How many batches of seeds we make from one key before asking the operating
+# system for a fresh one
+RESEED_INTERVAL = 1024
+
+# Found addresses are passed back to the main process through a "ring" of
+# slots in memory shared by every process. Each slot holds one seed and public
+# key, and a flag saying whether it is full. The main process reads slots in
+# the same order the subprocesses fill them, going back to the first slot
+# after the last one. Having a power of two slots means that "going back to
+# the first slot" is a quick bitwise AND rather than a division.
+RING_SLOTS = 1 << 10
+RING_MASK = RING_SLOTS - 1
+# CPUs share memory in chunks called "cache lines". Keeping things that
+# different processes write to in different chunks means they never slow each
+# other down. Most CPUs use 64 byte chunks, but Apple Silicon uses 128, so we
+# space everything out by 128 to be safe on both
+CACHE_LINE = 128
+# Each slot takes up exactly one of those chunks
+SLOT_LEN = CACHE_LINE
+SLOT_FULL = 2 * KEY_LEN
+# The number of slots the subprocesses have filled so far sits in its own
+# chunk, before the slots themselves
+RING_TAIL = 0
+RING_START = CACHE_LINE
+# Each subprocess keeps its own count, spaced out the same way, so the
+# subprocesses never slow each other down by writing next to each other
+COUNTER_STRIDE = CACHE_LINE // 8
+# How long a subprocess waits before trying again if every slot is full
+RING_FULL_WAIT = 0.01
+# How often to refresh the count of searched addresses, in seconds
+DISPLAY_INTERVAL = 0.5
 
 def main(**kwargs):
     """
@@ -29,11 +82,20 @@ def main(**kwargs):
     if re.match('^[A-Z2-7]+$', start) is None:
         raise ValueError('Invalid start. Can only contain upper case letters A-Z and numbers 2-7.')
 
-    # Each CPU core will communicate back to the main process via this queue
-    queue = Queue()
-    # The counter will be shared by each subprocess so we can tell how fast
-    # We're generating accounts
-    counter = Value('i', 0)
+    # Work out which bytes the address has to start with once, here, so the
+    # subprocesses never need to build the address text to check it
+    prefix = prefix_to_bits(start)
+
+    # Make sure we can add to the output file before we start searching
+    check_output_format(output)
+
+    # Each CPU core will communicate back to the main process via this ring of
+    # shared memory. The lock is only taken when something is actually found
+    ring = RawArray('B', RING_START + RING_SLOTS * SLOT_LEN)
+    ring_lock = Lock()
+    # And after filling a slot, it sends a message down this pipe to wake the
+    # main process up
+    wake_reader, wake_writer = Pipe(duplex=False)
 
     # Parse number of CPU cores to use based on user input or default values
     if cpu < 0:
@@ -41,6 +103,10 @@ def main(**kwargs):
     if cpu == 0:
         raise ValueError('Cannot have CPU set to 0')
 
+    # Each subprocess gets its own counter, shared with the main process, which
+    # adds them all up so we can tell how fast we're generating accounts
+    counters = RawArray('Q', cpu * COUNTER_STRIDE)
+
     # Output to let the user know what we're doing
     if number:
         print('Using {} process(es) to search for {} Algorand address(es) starting with {}'.format(cpu, number, start))
@@ -50,108 +116,375 @@ def main(**kwargs):
     # For each core we can use, start a new python Process, which will run the
     # code to generate and check addresses in the subprocess method below.
     processes = []
-    for _ in range(cpu):
-        p = Process(target=subprocess, args=(start, queue, counter))
+    for index in range(cpu):
+        p = Process(target=subprocess, args=(prefix, ring, ring_lock, wake_writer, counters, index))
         p.start()
         processes.append(p)
 
     number_found = 0
+    # How many slots of the ring we've read
+    num_read = 0
     previous_counted = 0
     num_counted = 0
+    previous_display = time.monotonic()
+    next_display = previous_display
     # Now the processes are underway, keep checking if we've found anything in
-    # the queue
+    # the ring
     try:
         while True:
-            # Compute and print out the number of addresses we've found and
-            # the rate we're progressing
-            previous_counted = num_counted
-            num_counted = counter.value
-            rate = (num_counted-previous_counted)//2
-            print('\rSearched addresses: {:13,} (~{:,}/sec)'.format(num_counted, rate), end="")
-            try:
-                # Check the queue for 2 seconds at a time, if we don't find anything
-                # start the loop again so we can refresh our counter display
-                item = queue.get(timeout=2)
-            except Empty:
-                continue
+            now = time.monotonic()
+            if now >= next_display:
+                # Compute and print out the number of addresses we've found and
+                # the rate we're progressing since we last did
+                previous_counted = num_counted
+                num_counted = sum(counters[::COUNTER_STRIDE])
+                rate = int((num_counted-previous_counted) / max(now - previous_display, 1e-9))
+                status = 'Searched addresses: {:13,} (~{:,}/sec)'.format(num_counted, rate)
+                print('\r' + status, end="")
+                previous_display = now
+                next_display = now + DISPLAY_INTERVAL
+
+            # Sleep until either a subprocess wakes us up because it found
+            # something, or it's time to refresh our counter display
+            if wait([wake_reader], timeout=max(next_display - time.monotonic(), 0)):
+                while wake_reader.poll():
+                    wake_reader.recv_bytes()
+
+            # Take everything that's been found out of the ring
+            found = ring_pop(ring, ring_lock, num_read)
+            while found is not None:
+                num_read += 1
 
-            # If we've made it here, it means we've found a matching address!
-            # print the address and add the full details to the JSON file
-            print()
-            print('Found!', item['address'])
-            write_to_json(item, output)
+                # If we've made it here, it means we've found a matching address!
+                # Produce its address and mnemonic (key phrase), print the address
+                # and add the full details to the JSON Lines file
+                item = describe_account(*found)
+                print()
+                print('Found!', item['address'])
+                write_to_json(item, output)
 
-            number_found += 1
-            # If we have a limit on the number we want to return, and we've reached
-            # that limit, break out of this loop
+                number_found += 1
+                # If we have a limit on the number we want to return, and we've
+                # reached that limit, stop looking
+                if number_found == number:
+                    break
+                # Otherwise put the count back underneath, so the display
+                # always ends with it
+                print(status, end="")
+                found = ring_pop(ring, ring_lock, num_read)
+
+            # And if we've reached that limit break out of this loop too
             if number_found == number:
                 break
     except KeyboardInterrupt:
         # In the case that we try to stop early by sending an interrupt, we should
-        # still tidy up, so catch the exception and continue to the cleanup
-        pass
-
-    # Stop and cleanup all of the previous processes
-    for p in processes:
-        p.terminate()
-        p.join()
+        # still tidy up, so catch the exception and continue to the cleanup.
+        # Finish the line with the count on it first
+        print()
+    finally:
+        # Stop and cleanup all of the previous processes, even if something
+        # went wrong while saving what we found
+        for p in processes:
+            p.terminate()
+            p.join()
 
-def subprocess(start, queue, counter):
+def subprocess(prefix, ring, ring_lock, wake_writer, counters, index):
     """
     Each instance of subprocess will continuously generate random accounts
     and check if they meet our criteria.
     """
-    for i in itertools.count():
+    prefix_bits, _, prefix_len = prefix
+    matches = make_matcher(prefix)
+    # Unless we're after more than 51 characters, the start of the address
+    # only depends on the public key, so there's no need to work out the
+    # checksum for every account
+    needs_checksum = prefix_len > KEY_LEN
+    # And if we are, the whole public key has to be exactly these bytes
+    key_prefix = prefix_bits.to_bytes(prefix_len, 'big')[:KEY_LEN]
+    # Our own count of how many accounts we've generated, and where we share it
+    counted = 0
+    counter = index * COUNTER_STRIDE
+    # Where the random seeds for each batch come from
+    pool = SeedPool(BATCH_SIZE * KEY_LEN)
+    while True:
         try:
-            # Generates a new random private key and the corresponding address
-            private_key, address = account.generate_account()
-            # If the start of the random address matches the phrase we're searching
-            # for we should return it.
-            if address.startswith(start):
-                # Produce the mnemonic (key phrase) and send it back to the main
-                # process along with the address
-                queue.put({
-                    'address': address,
-                    'mnemonic': mnemonic.from_private_key(private_key),
-                })
-
-            # Increment the counter every 1000 cycles
-            # (Any more regularly would cause needless delay)
-            if (i % 1000 == 0):
-                counter.value += 1000
+            # Generate a whole batch of new random keys at once. The seeds stay
+            # together in one block of bytes, and the public keys in one list
+            seeds = pool.next_batch()
+            for offset, public_key in zip(range(0, len(seeds), KEY_LEN), generate_batch(seeds)):
+                # The bytes the address is written from: the public key and
+                # (if we need it) its checksum
+                data = public_key
+                if needs_checksum:
+                    # Don't bother working out the checksum unless the public
+                    # key part already matches
+                    if public_key != key_prefix:
+                        continue
+                    data = public_key + checksum(public_key)
+                # If the first bits of those bytes match the phrase we're
+                # searching for we should return it.
+                if matches(data):
+                    # Only now do we cut this key's seed out of the block. Send
+                    # the raw key back to the main process, which builds the
+                    # address and mnemonic
+                    seed = seeds[offset:offset + KEY_LEN]
+                    ring_push(ring, ring_lock, seed, public_key)
+                    wake_writer.send_bytes(b'!')
+
+            # Update our counter once for each batch
+            # (Any more regularly would cause needless delay). Only this
+            # subprocess writes to it, so there's no need for a lock
+            counted += BATCH_SIZE
+            counters[counter] = counted
         except KeyboardInterrupt:
             # Ignore interrupts when closing, because we are handling them and
             # the requisite cleanup in the main process
             pass
 
+def prefix_to_bits(start):
+    """
+    Converts the characters we want an address to start with into the bits
+    those characters stand for.
+    Returns (bits, mask, length): the address matches when the first `length`
+    bytes of the public key and checksum, read as one big number and with
+    only the `mask` bits kept, are equal to `bits`.
+    """
+    # Each character is 5 bits, so glue them together into one number
+    bits = 0
+    for char in start:
+        bits = (bits << 5) | ALPHABET.index(char)
+    num_bits = len(start) * 5
+
+    # The final character of a full address has 2 more bits than the data
+    # needs. They are always zero, so if they aren't we'll never find a match
+    max_bits = (KEY_LEN + CHECKSUM_LEN) * 8
+    if num_bits > max_bits:
+        extra_bits = num_bits - max_bits
+        if extra_bits > 2 or bits & ((1 << extra_bits) - 1):
+            raise ValueError('Invalid start. No Algorand address can start with {}.'.format(start))
+        bits >>= extra_bits
+        num_bits = max_bits
+
+    # Round up to a whole number of bytes and line the bits up with the start
+    # of those bytes
+    length = (num_bits + 7) // 8
+    shift = length * 8 - num_bits
+    mask = ((1 << num_bits) - 1) << shift
+    return bits << shift, mask, length
+
+class SeedPool:
+    """
+    Endlessly produces `size` random bytes at a time, to be cut up into seeds.
+    Rather than asking the operating system for every batch, it takes one
+    random key from the operating system and stretches it out with the
+    ChaCha20 cipher (libsodium's randombytes_buf_deterministic).
+    """
+    def __init__(self, size):
+        self.size = size
+        self.key = None
+        self.batches_left = 0
+
+    def next_batch(self):
+        """
+        Returns the next `size` random bytes.
+        If this is interrupted part way through, the pool is left as it was,
+        so it can carry on being used afterwards.
+        """
+        if self.batches_left == 0:
+            # Every so often start again from a fresh key from the operating system
+            self.key = os.urandom(KEY_LEN)
+            self.batches_left = RESEED_INTERVAL
+        block = randombytes_buf_deterministic(KEY_LEN + self.size, self.key)
+        # The first 32 bytes become the key for the next block, and the key we
+        # just used is thrown away. So even if someone later got hold of the
+        # key, they couldn't work out seeds we've already handed out
+        self.key = block[:KEY_LEN]
+        self.batches_left -= 1
+        return block[KEY_LEN:]
+
+def make_matcher(prefix):
+    """
+    Builds a function that checks whether some bytes (a public key, and if
+    need be its checksum) are the start of an address we're looking for,
+    given the (bits, mask, length) from prefix_to_bits.
+    The start we're looking for never changes once we've begun, so rather than
+    one general test we build the quickest one for this particular start.
+    """
+    bits, mask, length = prefix
+    prefix_bytes = bits.to_bytes(length, 'big')
+    # When the start fills a whole number of bytes, matching is just a matter of
+    # checking the bytes start with them
+    if mask & 0xff == 0xff:
+        return lambda data: data.startswith(prefix_bytes)
+    # Otherwise every byte but the last has to match exactly, and only the
+    # first few bits of the last byte matter
+    head = prefix_bytes[:-1]
+    last = length - 1
+    last_bits = prefix_bytes[-1]
+    last_mask = mask & 0xff
+    return lambda data: data.startswith(head) and data[last] & last_mask == last_bits
+
+def generate_batch(seeds):
+    """
+    Generates a new Algorand key from every 32 bytes of random seeds.
+    Returns a list of the public keys as raw bytes, in the same order as the
+    seeds they were made from.
+    This is what the AlgoSDK does in account.generate_account(), but without
+    building the private key string and address for every single account.
+    """
+    public_keys = []
+    for offset in range(0, len(seeds), KEY_LEN):
+        # Turn the seed into its Ed25519 public key (the same library call the
+        # AlgoSDK makes under the hood). For Ed25519 keys (and the SHA-512 hash
+        # inside them) libsodium always runs its portable "ref10" code, the
+        # same on every CPU. We deliberately don't ship a faster version that
+        # uses special instructions like AVX2, to keep this easy to check.
+        # It already makes the key using ref10's table of precomputed points,
+        # so adding a second table like it here wouldn't speed anything up.
+        public_key, _ = crypto_sign_seed_keypair(seeds[offset:offset + KEY_LEN])
+        public_keys.append(public_key)
+    return public_keys
+
+def ring_push(ring, ring_lock, seed, public_key):
+    """
+    Writes a found seed and public key into the next free slot of the ring.
+    If every slot is full, waits for the main process to catch up.
+    """
+    while True:
+        with ring_lock:
+            tail, = struct.unpack_from('<Q', ring, RING_TAIL)
+            slot = RING_START + (tail & RING_MASK) * SLOT_LEN
+            # If the slot is still full, the main process hasn't caught up yet
+            if not ring[slot + SLOT_FULL]:
+                # Fill in the slot first, and only then mark it as full to
+                # tell the main process it is ready
+                struct.pack_into('32s32s', ring, slot, seed, public_key)
+                ring[slot + SLOT_FULL] = 1
+                struct.pack_into('<Q', ring, RING_TAIL, tail + 1)
+                return
+        time.sleep(RING_FULL_WAIT)
+
+def ring_pop(ring, ring_lock, num_read):
+    """
+    Takes the oldest found (seed, public key) out of the ring, given how many
+    slots have been read so far.
+    Returns None if nothing new has been found.
+    """
+    slot = RING_START + (num_read & RING_MASK) * SLOT_LEN
+    # Take a quick look at the slot's flag without the lock. Almost every time
+    # there is nothing there, and then we never need to bother the subprocesses
+    if not ring[slot + SLOT_FULL]:
+        return None
+    with ring_lock:
+        # Read the slot with the lock held, so we're sure to see everything the
+        # subprocess wrote, then mark it empty so it can be used again
+        found = struct.unpack_from('32s32s', ring, slot)
+        ring[slot + SLOT_FULL] = 0
+    return found
+
+def describe_account(seed, public_key):
+    """
+    Builds the address and mnemonic (key phrase) for a seed and public key,
+    ready to be written to the JSON Lines file.
+    """
+    private_key = base64.b64encode(seed + public_key).decode()
+    # The address is the public key and its checksum written out in base 32,
+    # without the "=" padding on the end
+    address = base64.b32encode(public_key + checksum(public_key)).rstrip(b'=').decode()
+    return {
+        'address': address,
+        'mnemonic': mnemonic.from_private_key(private_key),
+    }
+
+def checksum(public_key):
+    """
+    Returns the 4 byte checksum Algorand puts on the end of a public key,
+    which is the last 4 bytes of its SHA-512/256 hash.
+    """
+    # Python's own hashlib does this several times faster than the AlgoSDK,
+    # which makes a new hashing object through PyCryptodome every time.
+    # hashlib hands the work to OpenSSL, which uses the CPU's built in SHA-512
+    # instructions on the processors that have them.
+    if HAS_SHA512_256:
+        return hashlib.new('sha512_256', public_key).digest()[-CHECKSUM_LEN:]
+    return encoding.checksum(public_key)[-CHECKSUM_LEN:]
+
 def write_to_json(item, output):
     """
-    Append a given item to an array in a JSON file.
+    Append a given item to a JSON Lines file (one JSON object on each line).
     If need be, creates the file.
-    Has some fancy stuff in there to reduce risk of file corruption in event of
-    a crash or interrupt.
+    Only ever adds to the end of the file, so it takes the same time however
+    many addresses we've already found, and a crash or interrupt can at most
+    leave the very last line unfinished.
+    """
+    # Never add a line to the end of a file in the old format, it would stop
+    # that file being valid JSON
+    check_output_format(output)
+    line = json.dumps(item).encode() + b'\n'
+    with open(output, 'ab+') as f:
+        # If a crash left the last line unfinished, start on a fresh line so we
+        # don't add onto the end of it
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+        # Make sure it's actually saved to the disk before we carry on
+        f.flush()
+        os.fsync(f.fileno())
+
+def check_output_format(output):
+    """
+    Raises a ValueError if the output file is a single JSON array, as written
+    by older versions of this generator. We can't add lines to one of those
+    without ruining it, so a new output file has to be used instead.
+    A file that doesn't exist yet is fine.
     """
     try:
-        # If the file doesn't exist, just fill it with the first item
-        with open(output, 'x') as f:
-            json.dump([item], f, indent=2)
-    except FileExistsError:
-        # If the file does exist retrieve the list of everything we've found
-        # so far
-        with open(output, 'r') as f:
-            all_items = json.load(f)
-        # Add the new item to that list
-        all_items.append(item)
-
-        # Write the new list to a temporarty file so we don't corrupt the
-        # original in the event of a crash or interrupt
-        directory, file = os.path.split(output)
-        temp_output = os.path.join(directory, 'temp-{}'.format(file))
-        with open(temp_output, 'w') as f:
-            json.dump(all_items, f, indent=2)
-
-        # Replace the original file with its updated version
-        os.replace(temp_output, output)
+        with open(output, 'rb') as f:
+            # Find the first character that isn't a space or new line
+            while True:
+                chunk = f.read(4096)
+                if not chunk:
+                    # Empty (or only blank) files are fine
+                    return
+                chunk = chunk.lstrip()
+                if chunk:
+                    break
+    except FileNotFoundError:
+        return
+    if chunk.startswith(b'['):
+        raise ValueError(
+            '{} is in the JSON array format used by older versions of this generator. '
+            'It can still be read with json.load, but it can\'t be added to, so please '
+            'use a new output file.'.format(output))
+
+def load_hits(path):
+    """
+    Reads back the list of every item write_to_json has saved to a file.
+    Skips a line only if it was left unfinished by a crash or interrupt,
+    and raises a ValueError for anything else it can't read, so no saved
+    address is ever quietly left out.
+    """
+    # Files in the old format are one big JSON array, not one item per line
+    check_output_format(path)
+    hits = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                hits.append(json.loads(line))
+            except json.JSONDecodeError:
+                # write_to_json always writes a complete object on one line,
+                # and starts a fresh line after one that was cut off. So an
+                # unfinished line is one that starts an object but never gets
+                # as far as closing it
+                if line.startswith('{') and not line.endswith('}'):
+                    continue
+                raise ValueError('Line {} of {} could not be read: {}'.format(number, path, line))
+    return hits
 
 def get_max_cpus():
     """
@@ -171,7 +504,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""
         Produces valid Algorand Addresses which begin with a set series of characters.
-        Prints the addresses and writes the addresses and mnemonics in the JSON file format."""
+        Prints the addresses and writes the addresses and mnemonics in the JSON Lines file format."""
         )
     parser.add_argument(
         'start',
@@ -180,7 +513,7 @@ if __name__ == "__main__":
         )
     parser.add_argument(
         'output',
-        help="The file in which to write the mnemonics. If the file already exists, will attempt to read and append to it."
+        help="The file in which to write the mnemonics, one JSON object per line. If the file already exists, will append to it."
         )
     parser.add_argument(
         '--number',